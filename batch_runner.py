@@ -0,0 +1,420 @@
+"""
+Play through the levels without opening a window, to check that changes to
+the physics constants or the turret stats in game.py keep every level beatable.
+
+Each level is either played with a script of inputs, or a route to the goal
+is searched for. Every route is then played a few times with different turret
+timings, all spread over a process pool. The input goes through the game's
+own key and mouse handlers and update (game.Game), the same code the window runs.
+
+    python batch_runner.py
+    python batch_runner.py --levels 2 3 --runs 8
+    python batch_runner.py --search                 # search every level, ignore the scripts
+    python batch_runner.py --search --save-routes data/levels/routes
+
+By default the routes in data/levels/routes are played, which takes a few
+seconds. Levels without a route there, or whose route doesn't reach the goal
+anymore, get searched. Searching plays the real game for every move it
+tries, so a physics change that breaks the routes makes the check take
+about 20 seconds on a single core instead.
+
+A script has one line per stretch of input: how many ticks it lasts, which way
+to move (left, right or none) and optionally jump and/or shoot on its first tick:
+    40 right
+    1 right jump shoot
+"""
+import argparse
+import heapq
+import multiprocessing
+import os
+import random
+import time
+
+import arcade
+
+import game
+
+# Pauses don't matter without a window, and freezing would keep every
+# finished game alive
+game.GC_CONTROL = False
+
+# Ticks per second, the game runs at 60 updates a second
+TICKS_PER_SECOND = 60
+
+# Give up on a playthrough after this many ticks
+MAX_TICKS = 120 * TICKS_PER_SECOND
+
+# Searched routes are made of moves that are held for this many ticks
+MOVE_TICKS = 8
+
+# Most moves the route search tries per level before giving up
+SEARCH_LIMIT = 10000
+
+# How much the search prefers getting closer to the goal over a short route
+SEARCH_GREED = 5
+
+# Searched routes shoot every this many ticks, about as fast as clicking
+SHOOT_INTERVAL = 10
+
+# The game has no bottom, the search stops following a player who fell this
+# far below the lowest wall of the level
+FALL_DISTANCE = 500
+
+# Key that is held for each way of moving
+MOVE_KEYS = {-1: arcade.key.A, 1: arcade.key.D}
+
+SCORE_COUNT_FILE = "data/levels/score_count.txt"
+
+# Routes through each level that are known to work
+ROUTE_DIRECTORY = "data/levels/routes"
+
+
+def load_score_counts():
+    """
+    This function reads how many turrets each level has, so the score of a
+    playthrough can be compared with the best possible score.
+    """
+
+    score_counts = {}
+    with open(SCORE_COUNT_FILE) as score_file:
+        for line in score_file:
+            # Lines look like "level 1: 13"
+            if ":" in line:
+                name, count = line.split(":")
+                score_counts[int(name.split()[1])] = int(count)
+
+    return score_counts
+
+
+def copy_attributes(thing):
+    """ Copy the attributes of an object (or a copy of them), and the lists in them """
+
+    if not isinstance(thing, dict):
+        thing = thing.__dict__
+
+    attributes = {}
+    for name, value in thing.items():
+        if isinstance(value, list):
+            value = list(value)
+        attributes[name] = value
+    return attributes
+
+
+class HeadlessGame(game.Game):
+    """
+    The game playing a single level without a window. Instead of moving on
+    when the player dies or reaches the goal it stops and keeps the result.
+    """
+
+    def __init__(self, level, turrets=True):
+        # Only one level gets played, so there is nothing to build ahead
+        super().__init__(preload=False)
+
+        # "dead" or "goal" once the level is over
+        self.start_level = level
+        self.result = None
+
+        # Which way the movement keys are held, -1 is left and 1 is right
+        self.move = 0
+
+        self.level = level
+        self.setup(level)
+
+        # Without the turret scheduler the turrets never fire
+        if not turrets:
+            self.turret_scheduler = game.TurretScheduler()
+
+        # The game updates once before anything can be pressed
+        self.update(1 / TICKS_PER_SECOND)
+
+    def setup(self, level):
+        """ The first setup starts the level, after that the level is over """
+
+        if self.level_world is None:
+            super().setup(level)
+        elif self.result is None:
+            # The game sets up the same level again when the player died,
+            # and the next one when they reached the goal
+            if level == self.start_level:
+                self.result = "dead"
+            else:
+                self.result = "goal"
+
+    def tick(self, move, jump, shoot):
+        """ Press the keys for one tick and update the game, returns the result """
+
+        if move != self.move:
+            if self.move != 0:
+                self.on_key_release(MOVE_KEYS[self.move], 0)
+            if move != 0:
+                self.on_key_press(MOVE_KEYS[move], 0)
+            self.move = move
+        if jump:
+            self.on_key_press(arcade.key.W, 0)
+        if shoot:
+            self.on_mouse_press(0, 0, arcade.MOUSE_BUTTON_LEFT, 0)
+
+        self.update(1 / TICKS_PER_SECOND)
+        return self.result
+
+    def save(self):
+        """
+        Everything that changes while the player moves around, so the search
+        can go back to it. Lists get copied since some of them (like the
+        player's velocity) are changed in place
+        """
+
+        return copy_attributes(self), copy_attributes(self.player_sprite)
+
+    def load(self, state):
+        """ Go back to a saved state """
+
+        game_state, player_state = state
+        self.__dict__.update(copy_attributes(game_state))
+        self.player_sprite.__dict__.update(copy_attributes(player_state))
+
+
+def search_route(level):
+    """
+    This function searches for moves that get the player from the spawn to
+    the goal, with the turrets not firing. Returns one (move, jump, shoot)
+    per tick, or None if no route was found.
+    """
+
+    headless_game = HeadlessGame(level, turrets=False)
+    goal = headless_game.next_level_sprite
+    fall_limit = min(wall.bottom for wall in headless_game.wall_list) - FALL_DISTANCE
+
+    def ticks_left(player):
+        distance = abs(goal.center_x - player.center_x) + abs(goal.center_y - player.center_y)
+        return distance / (2 * game.MOVEMENT_SPEED)
+
+    # Weighted A*, each entry is (score, order, ticks, saved game, moves so far).
+    # Places count as the same when the player is in the same tile and going
+    # up or not, which keeps the number of places small enough that the
+    # search is done in seconds
+    queue = [(0, 0, 0, headless_game.save(), None)]
+    seen = set()
+    order = 1
+    route = None
+
+    while queue and order < SEARCH_LIMIT and route is None:
+        _, _, ticks, state, moves = heapq.heappop(queue)
+
+        # Jumping only does something when standing on the ground, and
+        # standing still is only worth it to jump straight up
+        headless_game.load(state)
+        if headless_game.physics_engine.can_jump():
+            choices = [(1, False), (1, True), (-1, False), (-1, True), (0, True)]
+        else:
+            choices = [(1, False), (-1, False)]
+
+        for move, jump in choices:
+            headless_game.load(state)
+            result = None
+            for tick in range(MOVE_TICKS):
+                result = headless_game.tick(move, jump and tick == 0, False)
+                if result:
+                    break
+
+            player = headless_game.player_sprite
+            if result == "dead" or player.center_y < fall_limit:
+                continue
+
+            next_moves = (moves, move, jump)
+            if result == "goal":
+                route = route_inputs(next_moves, tick + 1)
+                break
+
+            # Don't look at the same place twice
+            key = (int(player.center_x // game.TILE_SIZE), int(player.center_y // game.TILE_SIZE), player.change_y > 0)
+            if key in seen:
+                continue
+            seen.add(key)
+
+            next_ticks = ticks + MOVE_TICKS
+            score = next_ticks + SEARCH_GREED * ticks_left(player)
+            heapq.heappush(queue, (score, order, next_ticks, headless_game.save(), next_moves))
+            order += 1
+
+    return route
+
+
+def route_inputs(moves, last_ticks):
+    """
+    Turn the chain of searched moves into one (move, jump, shoot) per tick.
+    The last move only lasts until the goal was reached.
+    """
+
+    chain = []
+    while moves is not None:
+        moves, move, jump = moves
+        chain.append((move, jump))
+    chain.reverse()
+
+    inputs = []
+    for index, (move, jump) in enumerate(chain):
+        ticks = MOVE_TICKS
+        if index == len(chain) - 1:
+            ticks = last_ticks
+
+        for tick in range(ticks):
+            shoot = len(inputs) % SHOOT_INTERVAL == 0
+            inputs.append((move, jump and tick == 0, shoot))
+    return inputs
+
+
+def load_script(file_name):
+    """ Read a script file into one (move, jump, shoot) per tick """
+
+    inputs = []
+    with open(file_name) as script_file:
+        for line in script_file:
+            words = line.split()
+            if not words or words[0].startswith("#"):
+                continue
+
+            ticks = int(words[0])
+            move = {"left": -1, "right": 1}.get(words[1], 0)
+            for tick in range(ticks):
+                inputs.append((move, "jump" in words and tick == 0, "shoot" in words and tick == 0))
+    return inputs
+
+
+def save_script(file_name, inputs):
+    """ Write inputs as a script, ticks with the same input become one line """
+
+    lines = []
+    for move, jump, shoot in inputs:
+        name = {-1: "left", 1: "right"}.get(move, "none")
+        if lines and not jump and not shoot and lines[-1][1] == name and len(lines[-1]) == 2:
+            lines[-1][0] += 1
+        else:
+            line = [1, name]
+            if jump:
+                line.append("jump")
+            if shoot:
+                line.append("shoot")
+            lines.append(line)
+
+    with open(file_name, "w") as script_file:
+        for line in lines:
+            script_file.write(" ".join(str(word) for word in line) + "\n")
+
+
+def play(job):
+    """
+    This function plays one level with the given inputs and the turrets
+    firing, and returns how it went.
+    """
+
+    level, inputs, seed = job
+
+    # The turret timers are random, the seed makes each run repeatable
+    random.seed(seed)
+    headless_game = HeadlessGame(level)
+
+    # The update before the first input counts as well
+    ticks = 1
+    for move, jump, shoot in inputs[:MAX_TICKS - 1]:
+        ticks += 1
+        if headless_game.tick(move, jump, shoot):
+            break
+
+    return {
+        "level": level,
+        "completed": headless_game.result == "goal",
+        "ticks": ticks,
+        "damage": game.HEALTH - headless_game.player_health,
+        "score": headless_game.score,
+    }
+
+
+def play_routes(pool, routes, runs):
+    """ Play every route a few times with different turret timings """
+
+    jobs = []
+    for level, route in routes.items():
+        if route is not None:
+            for seed in range(runs):
+                jobs.append((level, route[0], seed))
+    return pool.map(play, jobs)
+
+
+def report(levels, routes, results, score_counts):
+    """ Print a line for each level """
+
+    print("level  route     completed  time to goal  damage      score")
+    for level in levels:
+        if routes[level] is None:
+            print(str(level).ljust(7) + "not found")
+            continue
+
+        level_results = [result for result in results if result["level"] == level]
+        completed = [result for result in level_results if result["completed"]]
+        line = str(level).ljust(7) + routes[level][1].ljust(10)
+        line += (str(len(completed)) + "/" + str(len(level_results))).ljust(11)
+
+        if completed:
+            times = [result["ticks"] / TICKS_PER_SECOND for result in completed]
+            line += (str(round(min(times), 1)) + "-" + str(round(max(times), 1)) + "s").ljust(14)
+        else:
+            line += "-".ljust(14)
+
+        damage = [result["damage"] for result in level_results]
+        line += (str(round(sum(damage) / len(damage), 1)) + " avg").ljust(12)
+
+        scores = [result["score"] for result in level_results]
+        line += str(max(scores)) + "/" + str(score_counts.get(level, 0) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play the levels headless to check they can be beaten.")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 3, 4, 5, 6], help="levels to play")
+    parser.add_argument("--runs", type=int, default=4, help="playthroughs per level, each with different turret timings")
+    parser.add_argument("--scripts", default=ROUTE_DIRECTORY, help="directory with screenN.txt scripts, levels without one get a searched route")
+    parser.add_argument("--search", action="store_true", help="search a route for every level instead of using the scripts, this is slower (about 20s on a single core)")
+    parser.add_argument("--save-routes", help="directory to save the routes that were played as scripts")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+
+    # Use the scripts that exist
+    routes = {}
+    for level in args.levels:
+        routes[level] = None
+        file_name = os.path.join(args.scripts, "screen" + str(level) + ".txt")
+        if not args.search and os.path.exists(file_name):
+            routes[level] = (load_script(file_name), "script")
+
+    with multiprocessing.Pool(args.processes) as pool:
+        results = play_routes(pool, routes, args.runs)
+
+        # A script that never reaches the goal anymore may just be out of date
+        # after a change to the physics, so those levels get searched as well
+        for level in args.levels:
+            if routes[level] is not None and not any(result["completed"] for result in results if result["level"] == level):
+                routes[level] = None
+                results = [result for result in results if result["level"] != level]
+
+        # Search for a route through the levels without one
+        to_search = [level for level in args.levels if routes[level] is None]
+        for level, inputs in zip(to_search, pool.map(search_route, to_search)):
+            if inputs is not None:
+                routes[level] = (inputs, "searched")
+        results += play_routes(pool, {level: routes[level] for level in to_search}, args.runs)
+
+    if args.save_routes:
+        os.makedirs(args.save_routes, exist_ok=True)
+        for level in args.levels:
+            if routes[level] is not None:
+                save_script(os.path.join(args.save_routes, "screen" + str(level) + ".txt"), routes[level][0])
+
+    report(args.levels, routes, results, load_score_counts())
+    print("Checked " + str(len(args.levels)) + " levels in " + str(round(time.perf_counter() - start_time, 1)) + "s")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,15 @@
 Load a map stored in csv format, as exported by the program 'Tiled.'
 """
 import arcade
+import gc
+import heapq
 import math
+import PIL.Image
 import random
 import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
@@ -25,6 +31,29 @@ GRAVITY = 0.2
 # Player health
 HEALTH = 100
 
+# Garbage collector control. When this is on, everything that is alive after
+# each setup() gets frozen so the collector stops walking it, automatic full
+# collections are turned off while playing and full collections only happen
+# when the game starts and when the cutscenes come on
+GC_CONTROL = True
+
+# How many young collections it takes before the collector runs a full one on
+# its own. This high it never happens in the middle of a level
+GC_FULL_THRESHOLD = 1000000
+
+# Show frame time, allocations and GC pauses on the hud (F1 prints a report).
+# Allocations are traced with tracemalloc, which makes every allocation
+# slower, so frame times are a bit higher with this on
+FRAME_STATS = False
+
+# Upper edges of the frame time histogram buckets in milliseconds
+FRAME_TIME_BUCKETS = [8, 12, 16.7, 20, 25, 33.3, 50, 100]
+
+# How many cutscenes to decode ahead of the one on screen and how many
+# decoded cutscenes to keep around at most
+CUTSCENE_LOOKAHEAD = 2
+CUTSCENE_CACHE_SIZE = 4
+
 
 def get_map(filename):
     """
@@ -60,6 +89,245 @@ def get_map(filename):
     return map_array
 
 
+def release_sprite_list(sprite_list):
+    """
+    This function unlinks the sprites from a sprite list that isn't used
+    anymore. Sprites and their lists point at each other, so without this
+    they could only be freed by a full collection.
+    """
+
+    for sprite in sprite_list:
+        sprite.sprite_lists.clear()
+
+
+class FrameStats:
+    """ Class that keeps track of frame times, allocations and GC pauses """
+
+    def __init__(self):
+        # Frame time histogram, the last bucket is for anything slower
+        # than the biggest bucket edge
+        self.frame_histogram = [0] * (len(FRAME_TIME_BUCKETS) + 1)
+        self.last_frame = None
+        self.frame_time = 0
+        self.worst_frame_time = 0
+
+        # Allocations per tick, a tick being an update and the draw after it.
+        # This is the peak of the memory allocated during the tick, so
+        # short lived things like hit lists, bullets and hud strings count
+        # even when they are freed in the same tick. Ticks with a level
+        # change or a full collection in them are left out instead of
+        # swamping the numbers
+        self.tick_started = False
+        self.tick_start_memory = 0
+        self.tick_skipped = False
+        self.tick_allocations = 0
+        self.worst_tick_allocations = 0
+        self.total_tick_allocations = 0
+        self.ticks = 0
+        self.skipped_ticks = 0
+
+        # GC pauses per generation
+        self.gc_start = None
+        self.gc_pause = 0
+        self.gc_pauses = [[], [], []]
+
+        # How long each level change took
+        self.transition_times = []
+
+        # Let the garbage collector tell us whenever it runs
+        gc.callbacks.append(self.on_gc)
+
+        # Start tracing allocations
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def on_gc(self, phase, info):
+        """ Called by the garbage collector before and after every collection """
+
+        if phase == "start":
+            self.gc_start = time.perf_counter()
+            if info["generation"] == 2:
+                self.tick_skipped = True
+        elif self.gc_start is not None:
+            self.gc_pause = (time.perf_counter() - self.gc_start) * 1000
+            self.gc_pauses[info["generation"]].append(self.gc_pause)
+            self.gc_start = None
+
+    def start_tick(self):
+        """ Called at the start of every update """
+
+        # The tick keeps going until the next frame is drawn
+        if self.tick_started:
+            return
+
+        tracemalloc.reset_peak()
+        self.tick_start_memory = tracemalloc.get_traced_memory()[0]
+        self.tick_started = True
+        self.tick_skipped = False
+
+    def end_tick(self):
+        """ Called after a frame is drawn """
+
+        if not self.tick_started:
+            return
+        self.tick_started = False
+
+        if self.tick_skipped:
+            self.skipped_ticks += 1
+            return
+
+        self.tick_allocations = tracemalloc.get_traced_memory()[1] - self.tick_start_memory
+        self.total_tick_allocations += self.tick_allocations
+        self.ticks += 1
+        if self.tick_allocations > self.worst_tick_allocations:
+            self.worst_tick_allocations = self.tick_allocations
+
+    def frame(self):
+        """ Called once every frame that is drawn """
+
+        self.end_tick()
+        now = time.perf_counter()
+
+        # The first frame has nothing to compare to
+        if self.last_frame is not None:
+            self.frame_time = (now - self.last_frame) * 1000
+            if self.frame_time > self.worst_frame_time:
+                self.worst_frame_time = self.frame_time
+
+            # Find which bucket the frame time goes into
+            bucket = len(FRAME_TIME_BUCKETS)
+            for index, edge in enumerate(FRAME_TIME_BUCKETS):
+                if self.frame_time <= edge:
+                    bucket = index
+                    break
+            self.frame_histogram[bucket] += 1
+
+        self.last_frame = now
+
+    def level_transition(self, transition_time):
+        """ Called after every level change with how long it took """
+
+        self.transition_times.append(transition_time)
+        self.tick_skipped = True
+
+    def hud_text(self):
+        """ Short one line summary for the hud """
+
+        return "Frame: " + str(round(self.frame_time, 1)) + "ms  Alloc: " + str(round(self.tick_allocations / 1024, 1)) + "KB  GC: " + str(round(self.gc_pause, 2)) + "ms"
+
+    def report(self):
+        """ Full report of everything that was measured """
+
+        lines = ["--- Frame stats ---"]
+
+        # Frame time histogram
+        lines.append("Frame times (worst " + str(round(self.worst_frame_time, 1)) + "ms):")
+        lower = 0
+        for index, count in enumerate(self.frame_histogram):
+            if index < len(FRAME_TIME_BUCKETS):
+                label = str(lower) + "-" + str(FRAME_TIME_BUCKETS[index]) + "ms"
+                lower = FRAME_TIME_BUCKETS[index]
+            else:
+                label = ">" + str(lower) + "ms"
+            lines.append("  " + label.ljust(14) + str(count))
+
+        # Allocations
+        if self.ticks:
+            average = self.total_tick_allocations / self.ticks
+            lines.append("Allocated per tick: average " + str(round(average / 1024, 1)) + "KB, worst " + str(round(self.worst_tick_allocations / 1024, 1)) + "KB (" + str(self.skipped_ticks) + " ticks with a level change or full collection left out)")
+
+        # Level changes
+        if self.transition_times:
+            lines.append("Level transitions: " + str(len(self.transition_times)) + ", last " + str(round(self.transition_times[-1], 1)) + "ms, worst " + str(round(max(self.transition_times), 1)) + "ms")
+
+        # GC pauses
+        for generation, pauses in enumerate(self.gc_pauses):
+            if pauses:
+                lines.append("GC gen " + str(generation) + ": " + str(len(pauses)) + " collections, worst " + str(round(max(pauses), 2)) + "ms, total " + str(round(sum(pauses), 2)) + "ms")
+            else:
+                lines.append("GC gen " + str(generation) + ": 0 collections")
+
+        return "\n".join(lines)
+
+
+class CutsceneSequencer:
+    """ Class that decodes the upcoming cutscenes in the background """
+
+    def __init__(self):
+        # Decoded cutscene textures in least recently used order.
+        # The values are futures so a cutscene that is still being
+        # decoded can already sit in the cache
+        self.cache = OrderedDict()
+
+        # One worker is enough since cutscenes are clicked through one by one
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def path(self, ending):
+        """ Order of the cutscenes that will be shown for the ending """
+
+        # The good and the bad ending both start with the first
+        # cutscene and then jump to their own images
+        if ending == "good":
+            return [0, 13, 14]
+        if ending == "bad":
+            return [0, 11, 12]
+
+        # Intro cutscenes, the 11th one is where level 1 starts
+        return list(range(12))
+
+    def load(self, index):
+        """ Decode a cutscene image, this runs on the worker thread """
+
+        file_name = "data/sprites/cutscenes/cutscene " + str(index) + ".png"
+        image = PIL.Image.open(file_name).convert("RGBA")
+
+        # Not using arcade.load_texture since it keeps every image
+        # it ever loaded in its own cache
+        texture = arcade.Texture(file_name, image)
+        texture.hit_box_points = arcade.calculate_points(image)
+        return texture
+
+    def prefetch(self, index):
+        """ Start decoding a cutscene if it isn't cached already """
+
+        if index in self.cache:
+            self.cache.move_to_end(index)
+        else:
+            self.cache[index] = self.executor.submit(self.load, index)
+
+        # Throw away the least recently used cutscenes
+        while len(self.cache) > CUTSCENE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def get_sprite(self, index, ending):
+        """ Make a sprite for the cutscene and decode the next ones ahead """
+
+        # This only waits if the cutscene wasn't decoded ahead
+        self.prefetch(index)
+        texture = self.cache[index].result()
+
+        cutscene = arcade.Sprite()
+        cutscene.texture = texture
+
+        # Cutscenes that already were shown on this path won't be shown again
+        path = self.path(ending)
+        if index in path:
+            position = path.index(index)
+            for spent in path[:position]:
+                self.cache.pop(spent, None)
+
+            # Decode the next cutscenes on the path
+            for upcoming in path[position + 1:position + 1 + CUTSCENE_LOOKAHEAD]:
+                self.prefetch(upcoming)
+
+        return cutscene
+
+    def clear(self):
+        """ Forget every decoded cutscene """
+
+        self.cache.clear()
+
+
 class Enemy(arcade.Sprite):
     """ Class for the enemy and their sprite """
     
@@ -98,7 +366,8 @@ class Enemy(arcade.Sprite):
             self.bullet_size = 0.7
             self.bullet_damage = 1
             
-        # How long has it been since we last fired?
+        # How long has it been since we last fired? The turret scheduler uses
+        # this to know when to fire first
         if self.time_between_firing >= 1:
             self.time_since_last_firing = random.randrange(0, self.time_between_firing - 1) + random.randrange(1, 10)/10
         else:
@@ -113,59 +382,231 @@ class Enemy(arcade.Sprite):
         # Set the target
         self.target = target
         
-    def on_update(self, delta_time: float = 1/60):
-        self.time_since_last_firing += delta_time
+    def fire(self):
+        """ Fire a bullet at the target, the turret scheduler calls this when it is time """
+        
+        # Spawn the bullet
+        bullet = arcade.Sprite(self.image_file, self.bullet_size)       
+        
+        # Set the bullet damage
+        bullet.damage = self.bullet_damage
         
-        # If we are past the firing time, then fire
-        if self.time_since_last_firing >= self.time_between_firing:
+        # Set the bullet spawn position
+        bullet.center_x = self.center_x
+        bullet.center_y = self.center_y
+        
+        # Calculate where the bullet would fire by using a little trig
+        y_diff = bullet.center_y - self.target.center_y
+        x_diff = bullet.center_x - self.target.center_x
+        distance = math.sqrt(x_diff**2 + y_diff**2)
+        
+        # Fire the bullet with the consistant speed such that
+        # as long as the bullet is from the same turret type
+        # their bullet speed will be the same no matter where
+        # it is firing
+        bullet.change_y = (-y_diff/distance) * self.bullet_speed
+        bullet.change_x = (-x_diff/distance) * self.bullet_speed
+        self.bullet_list.append(bullet)
 
-            # Reset timer
-            self.time_since_last_firing = 0
 
-            # Spawn the bullet
-            bullet = arcade.Sprite(self.image_file, self.bullet_size)       
-            
-            # Set the bullet damage
-            bullet.damage = self.bullet_damage
-            
-            # Set the bullet spawn position
-            bullet.center_x = self.center_x
-            bullet.center_y = self.center_y
-            
-            # Calculate where the bullet would fire by using a little trig
-            y_diff = bullet.center_y - self.target.center_y
-            x_diff = bullet.center_x - self.target.center_x
-            distance = math.sqrt(x_diff**2 + y_diff**2)
-            
-            # Fire the bullet with the consistant speed such that
-            # as long as the bullet is from the same turret type
-            # their bullet speed will be the same no matter where
-            # it is firing
-            bullet.change_y = (-y_diff/distance) * self.bullet_speed
-            bullet.change_x = (-x_diff/distance) * self.bullet_speed
-            self.bullet_list.append(bullet)
+class TurretScheduler:
+    """ Class that keeps a queue of when each turret fires next """
+
+    def __init__(self):
+        # In game time, it moves slower when time is slowed and not at all when it is stopped
+        self.clock = 0
 
+        # Heap of (fire time, order the turret was added in, turret).
+        # The order is there so turrets that fire at the same time never get compared
+        self.queue = []
+        self.turret_count = 0
 
-class MyGame(arcade.Window):
-    """ Main application class. """
+    def add(self, turret):
+        """ Put a turret in the queue """
 
-    def __init__(self):
-        """ Initializer """
+        fire_time = self.clock + turret.time_between_firing - turret.time_since_last_firing
+        heapq.heappush(self.queue, (fire_time, self.turret_count, turret))
+        self.turret_count += 1
+
+    def update(self, delta_time):
+        """ Move the clock forward and fire only the turrets that are due """
+
+        self.clock += delta_time
+
+        while self.queue and self.queue[0][0] <= self.clock:
+            fire_time, order, turret = heapq.heappop(self.queue)
+
+            # Destroyed turrets just fall out of the queue
+            if turret.health <= 0:
+                continue
+
+            # Fire and wait for the next shot
+            turret.fire()
+            heapq.heappush(self.queue, (self.clock + turret.time_between_firing, order, turret))
+
+
+class Level:
+    """ Class that holds all the sprites that are built from a level's map """
+
+    def __init__(self, level, target):
+        # Sprite lists. The walls and kill barriers never move, so a spatial
+        # hash lets every check against them look only at the ones close to
+        # the player
+        self.wall_list = arcade.SpriteList(use_spatial_hash=True)
+        self.enemy_list = arcade.SpriteList()
+        self.bullet_list = arcade.SpriteList()
+        self.kill_barrier_list = arcade.SpriteList(use_spatial_hash=True)
+        self.next_level_list = arcade.SpriteList()
+
+        # Sprites that don't move, only used for drawing. The walls go behind
+        # the player and the turrets, goal and kill barriers go in front of it
+        self.back_layer = arcade.SpriteList(is_static=True)
+        self.front_layer = arcade.SpriteList(is_static=True)
+
+        # Goal and respawn point of the level
+        self.next_level_sprite = None
+        self.spawn_point = None
+
+        # Decides which turrets fire on each update
+        self.turret_scheduler = TurretScheduler()
+
+        # Get a 2D array made of numbers based on which level it is
+        map_array = get_map("data/levels/csv version/screen" + str(level) + ".csv")
         
-        # Call the parent class
-        super().__init__(SCREEN_WIDTH, SCREEN_HEIGHT)
+        # Now that we've got the map, loop through and create the sprites
+        for row_index in range(len(map_array)):
+            for column_index in range(len(map_array[row_index])):
+                item = map_array[row_index][column_index]
+
+                # For this map, the numbers represent:
+                # 0  = groud
+                # 1  = platform
+                # 2  = standard turret
+                # 3  = sniper turret
+                # 4  = machine gun turret
+                # 5  = destroyer turret
+                if item == 0:
+                    wall_sprite = arcade.Sprite("data/sprites/stage/ground.png")
+                elif item == 1:
+                    wall_sprite = arcade.Sprite("data/sprites/stage/block.png")
+
+                # Calculate where the sprite goes                
+                if item == 0 or item == 1:
+                    wall_sprite.center_x = column_index * TILE_SIZE + 16
+                    wall_sprite.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16
+
+                    # Add the sprite
+                    self.wall_list.append(wall_sprite)
+                    self.back_layer.append(wall_sprite)
+                
+                # Place the turrets
+                if item >= 2 and item <= 5:
+                    if item == 2:
+                        turret = Enemy("data/sprites/enemies/standard turret.png", 1, "normal", self.bullet_list, target)
+                    elif item == 3:
+                        turret = Enemy("data/sprites/enemies/sniper turret.png", 1, "sniper", self.bullet_list, target)
+                    elif item == 4:
+                        turret = Enemy("data/sprites/enemies/machine gun turret.png", 1, "machine gun", self.bullet_list, target)
+                    elif item == 5:
+                        turret = Enemy("data/sprites/enemies/destroyer turret.png", 1, "destroyer", self.bullet_list, target)
+                    
+                    # Calculate where the sprite goes
+                    turret.center_x = column_index * TILE_SIZE + 16
+                    turret.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16
+                    self.enemy_list.append(turret)
+                    self.front_layer.append(turret)
+                    self.turret_scheduler.add(turret)
+                
+                # Sprites for kill barriers and respawn points as well as goals for each level
+                if item == 6:
+                    kill_barrier_sprite = arcade.Sprite("data/sprites/stage/kill barrier.png")
+                    kill_barrier_sprite.center_x = column_index * TILE_SIZE + 16
+                    kill_barrier_sprite.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16                    
+                    self.kill_barrier_list.append(kill_barrier_sprite)
+                    self.front_layer.append(kill_barrier_sprite)
+                if item == 7:
+                    self.next_level_sprite = arcade.Sprite("data/sprites/stage/next level.png")
+                    self.next_level_sprite.center_x = column_index * TILE_SIZE + 16
+                    self.next_level_sprite.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16                    
+                    self.next_level_list.append(self.next_level_sprite)
+                    self.front_layer.append(self.next_level_sprite)
+                if item == 8:
+                    self.spawn_point = arcade.Sprite("data/sprites/stage/spawn.png")
+                    self.spawn_point.center_x = column_index * TILE_SIZE + 16
+                    self.spawn_point.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16
+
+    def release(self):
+        """ Unlink all the sprites once the level isn't used anymore """
+
+        for sprite_list in [self.wall_list, self.enemy_list, self.bullet_list, self.kill_barrier_list, self.next_level_list, self.back_layer, self.front_layer]:
+            release_sprite_list(sprite_list)
+
+
+class LevelPreloader:
+    """ Class that builds levels on a worker thread before they are needed """
+
+    def __init__(self, target):
+        # The player, which the turrets of every level aim at
+        self.target = target
+
+        # Levels being built (or done) by level number
+        self.levels = {}
+
+        # One worker so building levels doesn't fight the game for the CPU too much
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def preload(self, levels):
+        """ Start building the levels, and forget any other ones """
+
+        # Levels that won't be played get released once they are built
+        for level in list(self.levels):
+            if level not in levels:
+                self.levels.pop(level).add_done_callback(lambda future: future.result().release())
+
+        for level in levels:
+            if level not in self.levels:
+                self.levels[level] = self.executor.submit(Level, level, self.target)
+
+    def take(self, level):
+        """ Get a built level, it can only be used once since playing changes it """
+
+        if level in self.levels:
+            return self.levels.pop(level).result()
+
+        # Nobody asked for this level ahead of time so build it now
+        return Level(level, self.target)
+
+
+class Game:
+    """
+    Everything about playing the game that doesn't need a window: the
+    levels, the input, and the game logic that runs on every update.
+    MyGame puts it in a window and batch_runner.py plays it headless.
+    """
+
+    def __init__(self, preload=True):
+        """ Initializer, preload is if upcoming levels get built on a worker thread """
 
         # Sprite lists
         self.player_list = None
         self.wall_list = None
         self.mimic_list = None
         self.enemy_list = None
+        self.turret_scheduler = None
         self.bullet_list = None
         self.next_level_list = None
         self.kill_barrier_list = None
         self.player_bullet_list = None
         self.cutscene_list = None
         
+        # Sprite lists that are only used for drawing
+        self.back_layer = None
+        self.actor_list = None
+        self.front_layer = None
+        
+        # The level that is being played
+        self.level_world = None
+        
         # Set up the player
         self.player_sprite = arcade.AnimatedTimeSprite()
         self.player_sprite.textures = []
@@ -187,14 +628,14 @@ class MyGame(arcade.Window):
         # If player is alive or not
         self.player_death = None        
         
-        # Loading the sounds
-        self.time_stop_sound = arcade.load_sound("data/sound effects/player/time stop.ogg")
-        self.time_slow_sound = arcade.load_sound("data/sound effects/player/time slow.ogg")
-        self.shoot_sound = arcade.load_sound("data/sound effects/player/shoot.ogg")
-        self.kill_sound = arcade.load_sound("data/sound effects/player/kill.ogg")
-        self.respawn_sound = arcade.load_sound("data/sound effects/player/respawn.ogg")
-        self.background_sound = arcade.load_sound("data/sound effects/environment/background.ogg")
-        self.hit_sound = arcade.load_sound("data/sound effects/player/hit.ogg")
+        # The sounds, they are loaded by the window
+        self.time_stop_sound = None
+        self.time_slow_sound = None
+        self.shoot_sound = None
+        self.kill_sound = None
+        self.respawn_sound = None
+        self.background_sound = None
+        self.hit_sound = None
         
         # Scores
         self.score = 0
@@ -219,18 +660,50 @@ class MyGame(arcade.Window):
         # What kind of cutscene the game is at
         self.cutscene_count = 0
         
-        # Play the background music
-        arcade.play_sound(self.background_sound, 0.06)
-        
         # Type of ending player got
         self.ending = None
         
         # A switch for endings to properly work
         self.switch = None
         
+        # Frame time, allocation and GC pause tracking, only when it is on
+        self.frame_stats = None
+        if FRAME_STATS:
+            self.frame_stats = FrameStats()
+        
+        # If the first full collection before the game starts happened yet
+        self.gc_frozen = False
+        
+        # Full collections only run at safe points, young ones still run on their own
+        if GC_CONTROL:
+            threshold0, threshold1, threshold2 = gc.get_threshold()
+            gc.set_threshold(threshold0, threshold1, GC_FULL_THRESHOLD)
+        
+        # Decodes cutscenes ahead of time
+        self.cutscene_sequencer = CutsceneSequencer()
+        
+        # Builds the upcoming levels ahead of time
+        self.preload = preload
+        self.level_preloader = LevelPreloader(self.player_sprite)
+        
+    def play_sound(self, sound, volume=1.0):
+        """ Play a sound, only the window can do that """
+        
+    def stop_sound(self, sound):
+        """ Stop a sound, only the window can do that """
+        
+    def set_view(self):
+        """ Scroll the view to view_left and view_bottom, only the window can do that """
+        
+    def end_game(self):
+        """ Close the game, only the window can do that """
+        
     def setup(self, level):
         """ Set up the game and initialize the variables. """
         
+        # Time how long setting up the level takes
+        setup_start = time.perf_counter()
+        
         # This is so I can reset the player score to where it was
         # before entering the level when the player dies
         self.score = self.saved_score
@@ -246,14 +719,19 @@ class MyGame(arcade.Window):
         # Mimic start timer 
         self.mimic_timer = 0        
         
-        # sprite lists
+        # Let go of the last level. The player and the mimic are taken out of
+        # their old lists and everything else gets unlinked, so it is all freed
+        # right away even though it was frozen
+        self.player_sprite.remove_from_sprite_lists()
+        self.mimic_sprite.remove_from_sprite_lists()
+        if self.level_world is not None:
+            self.level_world.release()
+            release_sprite_list(self.player_bullet_list)
+            release_sprite_list(self.cutscene_list)
+        
+        # sprite lists (the ones that come from the map are made by the level)
         self.player_list = arcade.SpriteList()
         self.mimic_list = arcade.SpriteList()
-        self.enemy_list = arcade.SpriteList()
-        self.bullet_list = arcade.SpriteList()  
-        self.wall_list = arcade.SpriteList()
-        self.kill_barrier_list = arcade.SpriteList()
-        self.next_level_list = arcade.SpriteList()
         self.player_bullet_list = arcade.SpriteList()
         self.cutscene_list = arcade.SpriteList()
         
@@ -276,82 +754,34 @@ class MyGame(arcade.Window):
         # Time meter
         self.time_meter = 100
         
-        # Get a 2D array made of numbers based on which level the player is at
+        # Level 0 is a cutscene stage so if it is level 0 then add a cutscene sprite
         if self.level == 0:
-            map_array = get_map("data/levels/csv version/screen0.csv")
-            
-            # Level 0 is a cutscene stage so if it is level 0 then add a cutscene sprite
-            cutscene = arcade.Sprite("data/sprites/cutscenes/cutscene 0.png")
-            
-        if self.level == 1:
-            map_array = get_map("data/levels/csv version/screen1.csv")
-        if self.level == 2:
-            map_array = get_map("data/levels/csv version/screen2.csv")
-        if self.level == 3:
-            map_array = get_map("data/levels/csv version/screen3.csv")
-        if self.level == 4:
-            map_array = get_map("data/levels/csv version/screen4.csv")
-        if self.level == 5:
-            map_array = get_map("data/levels/csv version/screen5.csv")
-        if self.level == 6:
-            map_array = get_map("data/levels/csv version/screen6.csv")
+            cutscene = self.cutscene_sequencer.get_sprite(0, self.ending)
         
-        # Now that we've got the map, loop through and create the sprites
-        for row_index in range(len(map_array)):
-            for column_index in range(len(map_array[row_index])):
-                item = map_array[row_index][column_index]
-
-                # For this map, the numbers represent:
-                # 0  = groud
-                # 1  = platform
-                # 2  = standard turret
-                # 3  = sniper turret
-                # 4  = machine gun turret
-                # 5  = destroyer turret
-                if item == 0:
-                    self.wall_sprite = arcade.Sprite("data/sprites/stage/ground.png")
-                elif item == 1:
-                    self.wall_sprite = arcade.Sprite("data/sprites/stage/block.png")
-
-                # Calculate where the sprite goes                
-                if item == 0 or item == 1:
-                    self.wall_sprite.center_x = column_index * TILE_SIZE + 16
-                    self.wall_sprite.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16
-
-                    # Add the sprite
-                    self.wall_list.append(self.wall_sprite)
-                
-                # Place the turrets
-                if item >= 2 and item <= 5:
-                    if item == 2:
-                        turret = Enemy("data/sprites/enemies/standard turret.png", 1, "normal", self.bullet_list, self.player_sprite)
-                    elif item == 3:
-                        turret = Enemy("data/sprites/enemies/sniper turret.png", 1, "sniper", self.bullet_list, self.player_sprite)
-                    elif item == 4:
-                        turret = Enemy("data/sprites/enemies/machine gun turret.png", 1, "machine gun", self.bullet_list, self.player_sprite)
-                    elif item == 5:
-                        turret = Enemy("data/sprites/enemies/destroyer turret.png", 1, "destroyer", self.bullet_list, self.player_sprite)
-                    
-                    # Calculate where the sprite goes
-                    turret.center_x = column_index * TILE_SIZE + 16
-                    turret.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16
-                    self.enemy_list.append(turret)
-                
-                # Sprites for kill barriers and respawn points as well as goals for each level
-                if item == 6:
-                    self.kill_barrier_sprite = arcade.Sprite("data/sprites/stage/kill barrier.png")
-                    self.kill_barrier_sprite.center_x = column_index * TILE_SIZE + 16
-                    self.kill_barrier_sprite.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16                    
-                    self.kill_barrier_list.append(self.kill_barrier_sprite)
-                if item == 7:
-                    self.next_level_sprite = arcade.Sprite("data/sprites/stage/next level.png")
-                    self.next_level_sprite.center_x = column_index * TILE_SIZE + 16
-                    self.next_level_sprite.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16                    
-                    self.next_level_list.append(self.next_level_sprite)
-                if item == 8:
-                    self.spawn_point = arcade.Sprite("data/sprites/stage/spawn.png")
-                    self.spawn_point.center_x = column_index * TILE_SIZE + 16
-                    self.spawn_point.center_y = (MAP_HEIGHT - row_index) * TILE_SIZE + 16
+        # Cutscenes aren't needed while playing, but the first one is shown
+        # again after level 6 so start decoding it there
+        elif self.level == 6:
+            self.cutscene_sequencer.prefetch(0)
+        else:
+            self.cutscene_sequencer.clear()
+        
+        # Take the level that was built in the background while the last one
+        # was played. If it isn't ready yet this waits for it (or builds it
+        # right here if it was never asked for)
+        level_world = self.level_preloader.take(self.level)
+        
+        # Swap the new level in
+        self.level_world = level_world
+        self.wall_list = level_world.wall_list
+        self.enemy_list = level_world.enemy_list
+        self.turret_scheduler = level_world.turret_scheduler
+        self.bullet_list = level_world.bullet_list
+        self.kill_barrier_list = level_world.kill_barrier_list
+        self.next_level_list = level_world.next_level_list
+        self.back_layer = level_world.back_layer
+        self.front_layer = level_world.front_layer
+        self.next_level_sprite = level_world.next_level_sprite
+        self.spawn_point = level_world.spawn_point
         
         # Add both the player and the mimic in the spritelist
         self.player_sprite.center_x = self.spawn_point.center_x
@@ -359,6 +789,11 @@ class MyGame(arcade.Window):
         self.player_list.append(self.player_sprite)
         self.mimic_list.append(self.mimic_sprite)
         
+        # The player and the mimic are drawn together
+        self.actor_list = arcade.SpriteList()
+        self.actor_list.append(self.player_sprite)
+        self.actor_list.append(self.mimic_sprite)
+        
         # Also spawn cutscene at the location of the player if its at stage 0
         if self.level == 0:
             cutscene.center_x = self.player_sprite.center_x + 100
@@ -370,9 +805,6 @@ class MyGame(arcade.Window):
                                                              self.wall_list,
                                                              gravity_constant=GRAVITY)
 
-        # Set the background color
-        arcade.set_background_color(arcade.color.BLACK)
-
         # Set the view port boundaries
         # These numbers set where we have 'scrolled' to.
         self.view_left = 0
@@ -380,57 +812,35 @@ class MyGame(arcade.Window):
         
         # A switch for endings to properly work
         self.switch = False        
-
-    def on_draw(self):
-        """ Render the screen. """
-        
-        # This command has to happen before we start drawing
-        arcade.start_render()
-
-        # Draw all the sprites.
-        self.wall_list.draw()
-        self.player_list.draw()
-        self.enemy_list.draw()
-        self.mimic_list.draw()
-        self.bullet_list.draw()
-        self.next_level_list.draw()
-        self.kill_barrier_list.draw()
-        
-        # If there is anything in the bullet list
-        # then draw
-        if len(self.player_bullet_list):
-            self.player_bullet_list.draw()
         
-        # Draw the hud
-        arcade.draw_text("Health: " + str(self.player_health), self.player_sprite.center_x - 160, self.player_sprite.center_y + 100, arcade.color.GREEN)
-        arcade.draw_text("Score: " + str(self.score), self.player_sprite.center_x + 100, self.player_sprite.center_y + 100, arcade.color.GREEN)
-        arcade.draw_text("Chronos: " + str(round(self.time_meter)), self.player_sprite.center_x + 100, self.player_sprite.center_y + 80, arcade.color.GREEN)
-        arcade.draw_text("Q: Rewind Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 60, arcade.color.GREEN)        
-        
-        # Depending on which ability the player unlocked, display a different text according to it
-        if self.score >= 1000 and self.score < 3300:
-            arcade.draw_text("Shift: Slow Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 80, arcade.color.GREEN)
-        if self.score >= 3300:
-            arcade.draw_text("Shift: Impowered Slow Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 80, arcade.color.GREEN)
-        if self.score >= 1800 and self.score < 4300:
-            arcade.draw_text("Space: Stop Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 100, arcade.color.GREEN)
-        if self.score >= 4300:
-            arcade.draw_text("Space: Impowered Stop Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 100, arcade.color.GREEN)
-        
-        # Give player the notification for unlocking abilities
-        if self.score == 1000:
-            arcade.draw_text("! Unlocked slow time !", self.player_sprite.center_x - 65, self.player_sprite.center_y + 50, arcade.color.RED)
-        if self.score == 1800:
-            arcade.draw_text("! Unlocked stop time !", self.player_sprite.center_x - 65, self.player_sprite.center_y + 50, arcade.color.RED)
-        if self.score == 3300:
-            arcade.draw_text("! Unlocked IMPROVED slow time !", self.player_sprite.center_x - 65, self.player_sprite.center_y + 50, arcade.color.RED)
-        if self.score == 4300:
-            arcade.draw_text("! Unlocked IMPROVED stop time !", self.player_sprite.center_x - 65, self.player_sprite.center_y + 50, arcade.color.RED)
+        # Level changes and deaths are a safe point. A young collection cleans
+        # up after the last level and then everything that is alive, including
+        # the level that was just swapped in, gets frozen so no collection
+        # walks it while it is played. The very first setup and the setup of
+        # the cutscene level run a full collection instead, since nothing is
+        # being played then. Frozen levels that get thrown away are freed by
+        # releasing them instead of by the collector
+        if GC_CONTROL:
+            if self.gc_frozen and self.level != 0:
+                gc.collect(1)
+            else:
+                gc.collect()
+                self.gc_frozen = True
+            gc.freeze()
+        
+        # Start building the level that comes after this one, and a fresh
+        # copy of this one in case the player dies. This is done last so
+        # the worker doesn't slow down the rest of the setup
+        if self.preload:
+            if self.level == 6:
+                next_level = 0
+            else:
+                next_level = self.level + 1
+            self.level_preloader.preload([self.level, next_level])
         
-        # If the level is 0 which is a cutscene level the draw the cutscene
-        if self.level == 0:
-            self.cutscene_list.draw()
-    
+        if self.frame_stats:
+            self.frame_stats.level_transition((time.perf_counter() - setup_start) * 1000)
+
     def on_key_press(self, key, modifiers):
         """ Called whenever the key is pressed. """
         
@@ -467,19 +877,23 @@ class MyGame(arcade.Window):
         # Slow down the time by 3 times when the player reaches certian score and has enough time meter
         elif key == arcade.key.LSHIFT and self.score >= 1000 and self.time_meter > 10:
             self.time_slow = 3
-            arcade.play_sound(self.time_slow_sound, 0.2)
+            self.play_sound(self.time_slow_sound, 0.2)
         
         # Slow down the time by 1000000 times so it appears that time has stopped
         # when the player reaches certian score and has enough time meter
         elif key == arcade.key.SPACE and self.score >= 1800 and self.time_meter > 10:
             self.time_slow = 100000000000
-            arcade.play_sound(self.time_stop_sound, 0.4)
+            self.play_sound(self.time_stop_sound, 0.4)
         
         elif key == arcade.key.Q:
             self.recall = True
         
         elif key == arcade.key.ESCAPE:
-            arcade.stop_sound(self.background_sound)
+            self.stop_sound(self.background_sound)
+        
+        # Print the frame stats report
+        elif key == arcade.key.F1 and self.frame_stats:
+            print(self.frame_stats.report())
 
     def on_key_release(self, key, modifiers):
         """ Called when the user lets go of a key. """
@@ -514,7 +928,7 @@ class MyGame(arcade.Window):
         bullet = arcade.Sprite("data/sprites/enemies/standard turret.png", 1)
         bullet.center_x = self.player_sprite.center_x
         bullet.center_y = self.player_sprite.center_y
-        arcade.play_sound(self.shoot_sound, 0.1)
+        self.play_sound(self.shoot_sound, 0.1)
         
         # Set the bullet movespeed depending on the direction
         bullet.movespeed = 0
@@ -539,7 +953,7 @@ class MyGame(arcade.Window):
             # If the the game shows us the ending scenes then close the window
             # on the next click
             if self.cutscene_count == 13 or self.cutscene_count == 15:
-                    arcade.close_window()            
+                    self.end_game()
             
             # Set which cutscene to play based on the ending
             if self.ending == "good" and self.switch == False:
@@ -552,9 +966,9 @@ class MyGame(arcade.Window):
             print(str(self.cutscene_count))
             
             # Instead of writing the code 14 times for 14 different cutscenes
-            # I made it so the directory just changes depending on which cutscene I am on
-            sprite_directory = "data/sprites/cutscenes/cutscene " + str(self.cutscene_count) + ".png"
-            cutscene = arcade.Sprite(sprite_directory)
+            # the sequencer finds the cutscene by its number. It was most likely
+            # decoded in the background already so this doesn't stall the click
+            cutscene = self.cutscene_sequencer.get_sprite(self.cutscene_count, self.ending)
             
             # Setting the location for the cutscene
             cutscene.center_x = self.player_sprite.center_x + 70
@@ -574,6 +988,9 @@ class MyGame(arcade.Window):
     def update(self, delta_time):
         """ Movement and game logic """
         
+        if self.frame_stats:
+            self.frame_stats.start_tick()
+        
         # Drain the time bar
         if self.time_slow >= 2:
             self.time_meter -= 0.5
@@ -596,12 +1013,11 @@ class MyGame(arcade.Window):
         # !!!THIS IS THE NEW UPDATE FOR EVERYTHING THAT IS AFFECTED BY TIME ELEMENTS!!!
         if self.time_count >= self.time_slow:
             
-            # Checking if a bullet hit the wall
-            for wall in self.wall_list:
-                ground_hit_list = arcade.check_for_collision_with_list(wall, self.bullet_list)
-                
-                # Removing bullets that did hit the wall
-                for bullet in ground_hit_list:
+            # Checking if a bullet hit the wall, and removing the ones that did.
+            # Going through the bullets uses the walls' spatial hash instead
+            # of going through every wall
+            for bullet in list(self.bullet_list):
+                if len(arcade.check_for_collision_with_list(bullet, self.wall_list)):
                     bullet.remove_from_sprite_lists()
             
             # Move the bullet
@@ -614,7 +1030,7 @@ class MyGame(arcade.Window):
             # Remove the bullet that hit the player and also subtract player's health by 30
             for bullet in player_hit_list:
                 self.player_health -= bullet.damage
-                arcade.play_sound(self.hit_sound)
+                self.play_sound(self.hit_sound)
                 bullet.remove_from_sprite_lists()
             
             # Kill the player if their health is below 0 and play a sound effect
@@ -633,17 +1049,16 @@ class MyGame(arcade.Window):
             # Kill the turret and add 100 in the score
             for turret in self.enemy_list:
                 if turret.health <= 0:
-                    arcade.play_sound(self.kill_sound, 0.1)
+                    self.play_sound(self.kill_sound, 0.1)
                     turret.remove_from_sprite_lists()
                     self.score += 100
             
             # Update the animation
             self.player_list.update_animation()
             
-            # Call update on all sprites
-            self.wall_list.update()
+            # Call update on all sprites (the walls never move)
             self.player_list.update()
-            self.enemy_list.on_update(delta_time)        
+            self.turret_scheduler.update(delta_time)
             self.bullet_list.update()
             
             # Updating the physics engine
@@ -743,10 +1158,7 @@ class MyGame(arcade.Window):
 
         # If we need to scroll, go ahead and do it.
         if changed:
-            arcade.set_viewport(self.view_left,
-                                SCREEN_WIDTH + self.view_left,
-                                self.view_bottom,
-                                SCREEN_HEIGHT + self.view_bottom)
+            self.set_view()
         
         # If player hit the kill barrier
         player_kill_list = arcade.check_for_collision_with_list(self.player_sprite, self.kill_barrier_list)
@@ -757,7 +1169,7 @@ class MyGame(arcade.Window):
         # If player died
         if self.player_death == True:
             self.player_death = False
-            arcade.play_sound(self.respawn_sound, 0.1)
+            self.play_sound(self.respawn_sound, 0.1)
             self.setup(self.level)
         
         # Code for going to next level:
@@ -782,10 +1194,118 @@ class MyGame(arcade.Window):
             self.level = 0
             self.setup(self.level)
 
+
+class MyGame(Game, arcade.Window):
+    """ Main application class. """
+
+    def __init__(self):
+        """ Initializer """
+        
+        # Open the window and set up the game
+        arcade.Window.__init__(self, SCREEN_WIDTH, SCREEN_HEIGHT)
+        Game.__init__(self)
+        
+        # Loading the sounds
+        self.time_stop_sound = arcade.load_sound("data/sound effects/player/time stop.ogg")
+        self.time_slow_sound = arcade.load_sound("data/sound effects/player/time slow.ogg")
+        self.shoot_sound = arcade.load_sound("data/sound effects/player/shoot.ogg")
+        self.kill_sound = arcade.load_sound("data/sound effects/player/kill.ogg")
+        self.respawn_sound = arcade.load_sound("data/sound effects/player/respawn.ogg")
+        self.background_sound = arcade.load_sound("data/sound effects/environment/background.ogg")
+        self.hit_sound = arcade.load_sound("data/sound effects/player/hit.ogg")
+        
+        # Play the background music
+        arcade.play_sound(self.background_sound, 0.06)
+        
+        # Set the background color
+        arcade.set_background_color(arcade.color.BLACK)
+        
+    def play_sound(self, sound, volume=1.0):
+        """ Play a sound """
+        
+        arcade.play_sound(sound, volume)
+        
+    def stop_sound(self, sound):
+        """ Stop a sound """
+        
+        arcade.stop_sound(sound)
+        
+    def set_view(self):
+        """ Scroll the view to view_left and view_bottom """
+        
+        arcade.set_viewport(self.view_left,
+                            SCREEN_WIDTH + self.view_left,
+                            self.view_bottom,
+                            SCREEN_HEIGHT + self.view_bottom)
+        
+    def end_game(self):
+        """ Close the window """
+        
+        arcade.close_window()
+        
+    def on_draw(self):
+        """ Render the screen. """
+        
+        # This command has to happen before we start drawing
+        arcade.start_render()
+
+        # Draw all the sprites. Each sprite list is one draw call, so the
+        # sprites are drawn in as few lists as the layering allows: walls,
+        # then the player and the mimic, then turrets, the goal and kill barriers
+        self.back_layer.draw()
+        self.actor_list.draw()
+        self.front_layer.draw()
+        self.bullet_list.draw()
+        
+        # If there is anything in the bullet list
+        # then draw
+        if len(self.player_bullet_list):
+            self.player_bullet_list.draw()
+        
+        # Draw the hud
+        arcade.draw_text("Health: " + str(self.player_health), self.player_sprite.center_x - 160, self.player_sprite.center_y + 100, arcade.color.GREEN)
+        arcade.draw_text("Score: " + str(self.score), self.player_sprite.center_x + 100, self.player_sprite.center_y + 100, arcade.color.GREEN)
+        arcade.draw_text("Chronos: " + str(round(self.time_meter)), self.player_sprite.center_x + 100, self.player_sprite.center_y + 80, arcade.color.GREEN)
+        arcade.draw_text("Q: Rewind Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 60, arcade.color.GREEN)        
+        
+        # Depending on which ability the player unlocked, display a different text according to it
+        if self.score >= 1000 and self.score < 3300:
+            arcade.draw_text("Shift: Slow Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 80, arcade.color.GREEN)
+        if self.score >= 3300:
+            arcade.draw_text("Shift: Impowered Slow Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 80, arcade.color.GREEN)
+        if self.score >= 1800 and self.score < 4300:
+            arcade.draw_text("Space: Stop Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 100, arcade.color.GREEN)
+        if self.score >= 4300:
+            arcade.draw_text("Space: Impowered Stop Time", self.player_sprite.center_x - 165, self.player_sprite.center_y - 100, arcade.color.GREEN)
+        
+        # Give player the notification for unlocking abilities
+        if self.score == 1000:
+            arcade.draw_text("! Unlocked slow time !", self.player_sprite.center_x - 65, self.player_sprite.center_y + 50, arcade.color.RED)
+        if self.score == 1800:
+            arcade.draw_text("! Unlocked stop time !", self.player_sprite.center_x - 65, self.player_sprite.center_y + 50, arcade.color.RED)
+        if self.score == 3300:
+            arcade.draw_text("! Unlocked IMPROVED slow time !", self.player_sprite.center_x - 65, self.player_sprite.center_y + 50, arcade.color.RED)
+        if self.score == 4300:
+            arcade.draw_text("! Unlocked IMPROVED stop time !", self.player_sprite.center_x - 65, self.player_sprite.center_y + 50, arcade.color.RED)
+        
+        # If the level is 0 which is a cutscene level the draw the cutscene
+        if self.level == 0:
+            self.cutscene_list.draw()
+        
+        # Draw the frame stats
+        if self.frame_stats:
+            self.frame_stats.frame()
+            arcade.draw_text(self.frame_stats.hud_text(), self.player_sprite.center_x - 165, self.player_sprite.center_y - 120, arcade.color.YELLOW)
+
+
 def main():
     window = MyGame()
     window.setup(window.level)
     arcade.run()
+    
+    # Print how the game performed once the window closes
+    if window.frame_stats:
+        print(window.frame_stats.report())
 
 
 if __name__ == "__main__":